@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
+import os
 
 import click
 
-from .loader import Loader
-from .utils import ObjectDict, is_tty
+from elasticsearch.exceptions import NotFoundError, TransportError
+
+from .database import ES, BULK_CHUNK_SIZE, MAPPING_PROFILES, SNAPSHOT_REPOSITORY, SNAPSHOT_LOCATION
+from . import profiler
+from .loader import Loader, DeadLetter, REPLAY_REJECTED, REPLAY_SELECTIONS
+from .profiler import TOP_K
+from .utils import ObjectDict, is_tty, human_size
 
 
 log = logging.getLogger(__name__)
@@ -94,6 +101,8 @@ class ClickFormatter(logging.Formatter):
 @click.option('-v', '--verbose', is_flag=True, help='Verbose output')
 @click.option('-es', '--elasticsearch', help='Elasticsearch URL', default='http://localhost:9200')
 @click.option('-i', '--index', help='Elasticsearch index name', default='sirene')
+@click.option('-m', '--mapping', type=click.Choice(sorted(MAPPING_PROFILES)), default='default',
+              help='Index mapping profile (only applied on index creation)')
 @click.pass_context
 def cli(ctx, **kwargs):
     '''Elasticsearch loader for SIRENE dataset'''
@@ -116,11 +125,15 @@ def cli(ctx, **kwargs):
 @click.option('-l', '--lines', type=int, help='Limit the amount of lines loaded')
 @click.option('-p', '--progress', type=int, help='Show progress every X lines')
 @click.option('-g', '--geo', is_flag=True, help='Process the geo-sirene files')
+@click.option('-c', '--chunk-size', type=click.IntRange(1), default=BULK_CHUNK_SIZE,
+              help='Amount of documents per bulk request')
+@click.option('-d', '--dead-letter', type=click.Path(dir_okay=False), help='Write rejected rows into this file')
 @click.pass_obj
-def load(config, path, lines=None, progress=None, geo=False):
+def load(config, path, lines=None, progress=None, geo=False, chunk_size=BULK_CHUNK_SIZE, dead_letter=None):
     '''Load data from a stock CSV file(s)'''
-    loader = Loader(config)
-    loader.load(path, lines=lines, progress=progress, geo=geo)
+    with DeadLetter(dead_letter) as deadletter:
+        loader = Loader(config, deadletter)
+        loader.load(path, lines=lines, progress=progress, geo=geo, chunk_size=chunk_size)
     click.echo(green(OK) + white(' Done'))
 
 
@@ -128,21 +141,84 @@ def load(config, path, lines=None, progress=None, geo=False):
 @click.argument('path', type=click.Path(exists=True))
 @click.option('-l', '--lines', type=int, help='Limit the amount of lines loaded')
 @click.option('-p', '--progress', type=int, help='Show progress every X lines')
+@click.option('-c', '--chunk-size', type=click.IntRange(1), default=BULK_CHUNK_SIZE,
+              help='Amount of documents per bulk request')
+@click.option('-d', '--dead-letter', type=click.Path(dir_okay=False), help='Write rejected rows into this file')
 @click.pass_obj
-def update(config, path, lines=None, progress=None):
+def update(config, path, lines=None, progress=None, chunk_size=BULK_CHUNK_SIZE, dead_letter=None):
     '''Load updates from daily generated CSV files'''
-    loader = Loader(config)
-    loader.update(path, lines=lines, progress=progress)
+    with DeadLetter(dead_letter) as deadletter:
+        loader = Loader(config, deadletter)
+        loader.update(path, lines=lines, progress=progress, chunk_size=chunk_size)
+    click.echo(green(OK) + white(' Done'))
+
+
+@cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('-c', '--chunk-size', type=click.IntRange(1), default=BULK_CHUNK_SIZE,
+              help='Amount of documents per bulk request')
+@click.option('-d', '--dead-letter', type=click.Path(dir_okay=False), help='Write rows rejected again into this file')
+@click.option('-s', '--select', type=click.Choice(REPLAY_SELECTIONS), default=REPLAY_REJECTED,
+              help='Replay rejected rows, rows indexed without invalid values or both')
+@click.pass_obj
+def replay(config, path, chunk_size=BULK_CHUNK_SIZE, dead_letter=None, select=REPLAY_REJECTED):
+    '''Replay rows rejected into a dead-letter file'''
+    if dead_letter and os.path.abspath(dead_letter) == os.path.abspath(path):
+        raise click.BadParameter('must differ from the replayed file', param_hint='--dead-letter')
+    with DeadLetter(dead_letter) as deadletter:
+        loader = Loader(config, deadletter)
+        loader.replay(path, chunk_size=chunk_size, select=select)
     click.echo(green(OK) + white(' Done'))
 
 
+@cli.command()
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'), default='profile.json',
+              help='JSON report file (use "-" for stdout)')
+@click.option('-l', '--lines', type=int, help='Limit the amount of lines profiled by file')
+@click.option('-p', '--progress', type=int, help='Show progress every X lines')
+@click.option('-g', '--geo', is_flag=True, help='Process the geo-sirene files')
+@click.option('-k', '--top', type=click.IntRange(1), default=TOP_K,
+              help='Amount of most frequent values reported by field')
+@click.option('-w', '--workers', type=click.IntRange(1), help='Amount of worker processes (defaults to CPU count)')
+def profile(paths, output, lines=None, progress=None, geo=False, top=TOP_K, workers=None):
+    '''Profile the mapped fields values of CSV file(s) without indexing'''
+    report = profiler.profile(paths, lines=lines, progress=progress, geo=geo, top=top, workers=workers)
+    json.dump(report.to_dict(), output, indent=2, ensure_ascii=False)
+    output.write('\n')
+    click.echo(green(OK) + white(' {0} rows profiled'.format(report.rows)), err=output.name == '<stdout>')
+
+
 @cli.command()
 @click.pass_obj
 def info(config):
     '''Display configuration and data statistics'''
     click.echo(cyan('SplashES configuration'))
     for key, value in config.items():
-        click.echo('{0}: {1}'.format(white(key), value))
+        label = 'mapping (on creation)' if key == 'mapping' else key
+        click.echo('{0}: {1}'.format(white(label), value))
+
+    es = ES(config, create=False)
+    # Failures are reported below, avoid elasticsearch client logged tracebacks
+    es_logger = logging.getLogger('elasticsearch')
+    level = es_logger.level
+    es_logger.setLevel(logging.CRITICAL)
+    try:
+        stats = es.index_stats()
+    except NotFoundError:
+        log.warning('Index %s does not exist', config.index)
+        return
+    except TransportError as e:
+        log.warning('Unable to get index statistics from %s: %s', config.elasticsearch, e)
+        return
+    finally:
+        es_logger.setLevel(level)
+    for name, index in sorted(stats.items()):
+        click.echo(cyan('Index {0}'.format(name)))
+        click.echo('{0}: {1}'.format(white('mapping'), index['mapping']))
+        click.echo('{0}: {1}'.format(white('documents'), index['documents']))
+        click.echo('{0}: {1}'.format(white('primaries size'), human_size(index['primaries_size'])))
+        click.echo('{0}: {1}'.format(white('total size'), human_size(index['total_size'])))
 
 
 @cli.command()
@@ -156,6 +232,44 @@ def denormalize(config, specs, force=False):
     loader.denormalize(specs, force=force)
 
 
+@cli.command()
+@click.argument('name', required=False)
+@click.option('-r', '--repository', default=SNAPSHOT_REPOSITORY, help='Snapshot repository name')
+@click.option('-l', '--location', default=SNAPSHOT_LOCATION, help='Snapshot repository location on Elasticsearch')
+@click.pass_obj
+def snapshot(config, name=None, repository=SNAPSHOT_REPOSITORY, location=SNAPSHOT_LOCATION):
+    '''Snapshot the index into a filesystem repository'''
+    es = ES(config, create=False)
+    try:
+        name = es.snapshot_index(name, repository=repository, location=location)
+    except ValueError as e:
+        log.error(str(e))
+        raise click.Abort()
+    click.echo(green(OK) + white(' Snapshot {0} created'.format(name)))
+
+
+@cli.command()
+@click.argument('name')
+@click.option('-t', '--target', help='Restored index name (defaults to "<index>-<snapshot>")')
+@click.option('-a', '--alias', help='Alias to switch to the restored index (defaults to the index name)')
+@click.option('-c', '--clone', is_flag=True, help='Only restore the index without switching any alias')
+@click.option('--replace', is_flag=True, help='Delete an existing index having the alias name once restored')
+@click.option('-r', '--repository', default=SNAPSHOT_REPOSITORY, help='Snapshot repository name')
+@click.option('-l', '--location', default=SNAPSHOT_LOCATION, help='Snapshot repository location on Elasticsearch')
+@click.pass_obj
+def restore(config, name, target=None, alias=None, clone=False, replace=False,
+            repository=SNAPSHOT_REPOSITORY, location=SNAPSHOT_LOCATION):
+    '''Restore a snapshot as a new index behind the alias'''
+    es = ES(config, create=False)
+    alias = None if clone else alias or config.index
+    try:
+        index = es.restore_index(name, target, alias, replace, repository=repository, location=location)
+    except ValueError as e:
+        log.error(str(e))
+        raise click.Abort()
+    click.echo(green(OK) + white(' Snapshot {0} restored as {1}'.format(name, index)))
+
+
 @cli.command()
 @click.pass_obj
 def shell(config):
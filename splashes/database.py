@@ -1,16 +1,32 @@
+import json
 import logging
+import re
 
 from datetime import datetime, date
 
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError, SerializationError, TransportError
+from elasticsearch.serializer import JSONSerializer
 from elasticsearch_dsl import analyzer, tokenizer, token_filter, Index as ESIndex
 
 
 from elasticsearch_dsl import (
-    DocType, Text, Keyword, Date, Boolean, Object, GeoPoint, Integer,
+    DocType, Text, Keyword, Date, Boolean, Object, GeoPoint, Integer, MetaField,
     analyzer, InnerObjectWrapper, Q
 )
 
+from .utils import chunked, format_error
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
 log = logging.getLogger(__name__)
 
@@ -61,7 +77,7 @@ MAPPING = {
     'name': 'NOMEN_LONG',
     'headquarter': 'SIEGE',
     'sign': 'ENSEIGNE',
-    'categorie': 'CATEGORIE',
+    'category': 'CATEGORIE',
     'legal': 'NJ',
     'ape': 'APEN700',
     'region': 'RPET',
@@ -91,6 +107,21 @@ INTEGER_MAPPING = {
     'workforce': 'EFENCENT',
 }
 
+#: Default amount of documents sent in a single bulk request
+BULK_CHUNK_SIZE = 500
+
+#: Bulk action line template (the document `_id` is interpolated as JSON)
+BULK_ACTION = b'{"index":{"_id":%s}}\n'
+
+#: Default snapshot repository name
+SNAPSHOT_REPOSITORY = 'splashes'
+
+#: Default snapshot repository location (needs to be listed in Elasticsearch `path.repo`)
+SNAPSHOT_LOCATION = '/usr/share/elasticsearch/data/snapshots'
+
+#: Snapshot and restore operations timeout (in seconds)
+SNAPSHOT_TIMEOUT = 3600
+
 #: For response fields details see:
 #: See https://www.elastic.co/guide/en/elasticsearch/reference/5.0/\
 #:      docs-update-by-query.html#docs-update-by-query-response-body
@@ -101,8 +132,12 @@ Summary:
 '''.strip()
 
 
-def parse_date(value, fmt):
-    '''A failsafe date parser'''
+def parse_date(value, fmt, errors=None):
+    '''
+    A failsafe date parser
+
+    Parsing errors are appended to `errors` if given, logged otherwise.
+    '''
     if not value:
         return None
     elif isinstance(value, (date, datetime)):
@@ -110,18 +145,31 @@ def parse_date(value, fmt):
     try:
         return datetime.strptime(value, fmt).date()
     except Exception as e:
-        log.exception('Unable to parse date "%s": %s', value, e)
+        if errors is None:
+            log.exception('Unable to parse date "%s": %s', value, e)
+        else:
+            errors.append('Unable to parse date "{0}": {1}'.format(value, e))
         return None
 
 
+def format_date(value, fmt, errors=None):
+    '''A failsafe date parser returning an ISO formatted string'''
+    value = parse_date(value, fmt, errors)
+    return value.isoformat() if value else None
+
+
 def parse_boolean(value):
     '''a failsafe boolean parser'''
     # TODO: need implementation
     return value
 
 
-def parse_int(value):
-    '''a failsafe integer parser'''
+def parse_int(value, errors=None):
+    '''
+    A failsafe integer parser
+
+    Parsing errors are appended to `errors` if given, logged otherwise.
+    '''
     if not value or value == 'NN':
         return None
     elif isinstance(value, int):
@@ -129,10 +177,94 @@ def parse_int(value):
     try:
         return int(value)
     except Exception as e:
-        log.exception('Unable to parse integer "%s": %s', value, e)
+        if errors is None:
+            log.exception('Unable to parse integer "%s": %s', value, e)
+        else:
+            errors.append('Unable to parse integer "{0}": {1}'.format(value, e))
         return None
 
 
+def log_error(source, line, error, data, indexed=False):
+    '''Default rejected rows handler: only log them'''
+    if indexed:
+        log.warning('Row %s:%s indexed without invalid values: %s', source, line, error)
+    else:
+        log.error('Unable to save row %s:%s: %s', source, line, error)
+
+
+def extract(row, date_parser=parse_date, errors=None):
+    '''
+    Extract the document fields values from a raw CSV row.
+
+    `row` only needs a dict-like `get` method so this works
+    with both raw `dict` and :class:`Csv` objects.
+    Values parsing errors are appended to `errors` if given, logged otherwise.
+    '''
+    values = {}
+
+    # Bulk map raw fields
+    for key, field in MAPPING.items():
+        values[key] = row.get(field)
+
+    # Bulk map raw date fields
+    for key, (field, fmt) in DATE_MAPPING.items():
+        values[key] = date_parser(row.get(field), fmt, errors)
+
+    for key, field in INTEGER_MAPPING.items():
+        values[key] = parse_int(row.get(field), errors)
+
+    # Bulk map raw boolean fields
+    for key, field in BOOLEAN_MAPPING.items():
+        values[key] = parse_boolean(row.get(field))
+
+    # Set computed values
+    values['siret'] = values['siren'] + values['nic']
+
+    if row.get('longitude') and row.get('latitude'):
+        values['location'] = '{0},{1}'.format(row.get('latitude'), row.get('longitude'))
+
+    return values
+
+
+class FastJSONSerializer(JSONSerializer):
+    '''
+    A JSON serializer relying on `orjson` or `ujson` when available
+    and falling back on the default `elasticsearch` serializer otherwise.
+    '''
+    def dumps_bytes(self, data):
+        '''Serialize `data` into UTF-8 encoded JSON bytes'''
+        if isinstance(data, bytes):
+            return data
+        elif orjson:
+            try:
+                return orjson.dumps(data, default=self.default)
+            except TypeError as e:
+                raise SerializationError(data, e)
+        elif ujson:
+            try:
+                return ujson.dumps(data, ensure_ascii=False).encode('utf-8')
+            except (TypeError, OverflowError):
+                # Types unknown from ujson (ie. dates) need the slow path
+                pass
+        try:
+            return json.dumps(data, default=self.default, ensure_ascii=False).encode('utf-8')
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return data
+        return self.dumps_bytes(data).decode('utf-8')
+
+    def loads(self, s):
+        if not orjson:
+            return super().loads(s)
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+
 class Csv(InnerObjectWrapper):
     def get(self, name):
         '''Dict-like for easier extraction'''
@@ -184,68 +316,159 @@ class Company(DocType):
     # Local Tracking
     last_update = Date()
 
+    class Meta:
+        # Keep track of the mapping profile into the index mapping
+        meta = MetaField(profile='default')
+
     def save(self, **kwargs):
-        # Bulk map raw fields
-        for key, field in MAPPING.items():
-            setattr(self, key, self.csv.get(field))
+        for key, value in extract(self.csv).items():
+            setattr(self, key, value)
 
-        # Bulk map raw date fields
-        for key, (field, fmt) in DATE_MAPPING.items():
-            try:
-                date = parse_date(self.csv.get(field), fmt)
-            except ValueError:
-                continue
-            setattr(self, key, date)
+        self.meta.id = self.siret
+        self.last_update = datetime.now()
 
-        for key, field in INTEGER_MAPPING.items():
-            try:
-                value = parse_int(self.csv.get(field))
-            except ValueError:
-                continue
-            setattr(self, key, value)
+        return super().save(**kwargs)
 
-        # Bulk map raw boolean fields
-        for key, field in BOOLEAN_MAPPING.items():
-            try:
-                value = parse_boolean(self.csv.get(field))
-            except ValueError:
-                continue
-            setattr(self, key, value)
 
-        # Set computed values
-        self.meta.id = self.siret = self.siren + self.nic
-        self.last_update = datetime.now()
+class LeanCompany(Company):
+    '''
+    A lighter `Company` mapping trading unused search features for a smaller index:
 
-        if self.csv.get('longitude') and self.csv.get('latitude'):
-            self.location = '{0},{1}'.format(self.csv.latitude, self.csv.longitude)
+    - raw CSV values are stored in `_source` only
+    - identifiers are not aggregatable
+    - facets keywords global ordinals are built on refresh instead of on first aggregation
+    - only `name` keeps a `raw` keyword subfield
+    - undeclared fields are kept in `_source` but not indexed
+    '''
+    siret = Keyword(doc_values=False)
+    siren = Keyword(doc_values=False)
+    nic = Keyword(doc_values=False)
+    rna = Keyword(doc_values=False)
 
-        return super().save(**kwargs)
+    category = Keyword(eager_global_ordinals=True)
+    legal = Keyword(eager_global_ordinals=True)
+    ape = Keyword(eager_global_ordinals=True)
+    region = Keyword(eager_global_ordinals=True)
+    departement = Keyword(eager_global_ordinals=True)
+    workforce_block = Keyword(eager_global_ordinals=True)
+    headquarter_region = Keyword(eager_global_ordinals=True)
+    shop_type = Keyword(eager_global_ordinals=True)
+
+    # SIEGE is a flag, no need for full-text
+    headquarter = Keyword()
+
+    sign = Text(analyzer=fr_analyzer)
+
+    # Raw CSV values
+    csv = Object(doc_class=Csv, enabled=False)
+
+    class Meta:
+        doc_type = 'company'
+        meta = MetaField(profile='lean')
+        dynamic = MetaField('false')
+
+
+#: Available mapping profiles as `(document class, index settings)`
+MAPPING_PROFILES = {
+    'default': (Company, {}),
+    'lean': (LeanCompany, {
+        'number_of_shards': 2,
+        'number_of_replicas': 0,
+        'codec': 'best_compression',
+    }),
+}
 
 
 class ES(Elasticsearch):
     '''An elasticsearch connection manager/wrapper'''
 
-    def __init__(self, config):
-        super().__init__([config.elasticsearch])
+    def __init__(self, config, create=True, serializer=None):
+        super().__init__([config.elasticsearch], serializer=serializer or FastJSONSerializer())
         self.config = config
+        self.doc_class, settings = MAPPING_PROFILES[config.mapping or 'default']
+        # Documents are bound to the alias so they follow it (ie. on restore)
         index = Index(config.index, using=self)
-        index.doc_type(Company)
-        if not index.exists():
+        index.doc_type(self.doc_class)
+        if create and not index.exists():
+            # Indices are created behind an alias so they can be swapped
+            name = '{0}-{1:%Y%m%d%H%M%S}'.format(config.index, datetime.now())
+            index = Index(name, using=self)
+            index.doc_type(self.doc_class)
+            index.settings(**settings)
+            index.aliases(**{config.index: {}})
+            log.info('Creating index %s as %s with the %s mapping profile',
+                     name, config.index, config.mapping or 'default')
             index.create()
 
     def save_company(self, data):
         '''Save a company from its raw CSV data'''
-        company = Company(csv=data)
+        company = self.doc_class(csv=data)
         company.save(using=self)
         return company
 
+    def save_companies(self, rows, chunk_size=BULK_CHUNK_SIZE, source=None, on_error=None, prepare=None):
+        '''
+        Bulk save companies from their raw CSV data given as `(line, data)` pairs.
+
+        An optionnal `prepare(data)` function can alter the raw data before indexing.
+        Rows failing either to be prepared, transformed or indexed are given to
+        the `on_error(source, line, error, data)` callback (defaults to logging)
+        with their original data. So are the rows having values failing to be parsed
+        with `indexed=True`, those being indexed anyway without these values.
+
+        Returns the number of successfully indexed companies.
+        '''
+        on_error = on_error or log_error
+        url = '/{0}/{1}/_bulk'.format(self.config.index, self.doc_class._doc_type.name)
+        total = 0
+        for chunk in chunked(rows, chunk_size):
+            accepted, body = [], []
+            last_update = datetime.now().isoformat()
+            for line, data in chunk:
+                errors = []
+                try:
+                    body.extend(self.bulk_lines(prepare(data) if prepare else data, last_update, errors))
+                except Exception as e:
+                    on_error(source, line, format_error(e), data)
+                    continue
+                accepted.append((line, data, errors))
+            if not accepted:
+                continue
+            result = self.transport.perform_request('POST', url, body=b''.join(body))
+            total += len(accepted)
+            for (line, data, errors), item in zip(accepted, result['items']):
+                error = item['index'].get('error')
+                if error:
+                    total -= 1
+                    on_error(source, line, error, data)
+                elif errors:
+                    on_error(source, line, '; '.join(errors), data, indexed=True)
+        return total
+
+    def bulk_lines(self, data, last_update=None, errors=None):
+        '''Serialize a raw CSV row into its bulk index lines (as bytes)'''
+        dumps = self.dumps_bytes
+        doc = extract(data, format_date, errors)
+        doc['csv'] = data
+        doc['last_update'] = last_update or datetime.now().isoformat()
+        return BULK_ACTION % dumps(doc['siret']), dumps(doc), b'\n'
+
+    def dumps_bytes(self, data):
+        '''Serialize `data` into JSON bytes, whatever the configured serializer is'''
+        serializer = self.transport.serializer
+        if hasattr(serializer, 'dumps_bytes'):
+            return serializer.dumps_bytes(data)
+        # Serializers pass strings through as already serialized
+        data = json.dumps(data, ensure_ascii=False) if isinstance(data, str) else serializer.dumps(data)
+        return data if isinstance(data, bytes) else data.encode('utf-8')
+
     def get_company(self, siret):
         '''Get a company from its SIRET'''
-        return Company.get(id=siret, using=self, index=self.config.index)
+        return self.doc_class.get(id=siret, using=self, index=self.config.index)
 
     def search_companies(self):
         '''Get a Search object for companies'''
-        return Company.search(using=self, index=self.config.index)
+        return self.doc_class.search(using=self, index=self.config.index)
 
     def denormalize(self, field, target_field, mapping, force=False):
         '''
@@ -274,7 +497,7 @@ class ES(Elasticsearch):
         timeout = self.search_companies().query(query).count()
         result = self.update_by_query(
             index=self.config.index,
-            doc_type=Company._doc_type.name,
+            doc_type=self.doc_class._doc_type.name,
             body=body,
             request_timeout=timeout
         )
@@ -284,3 +507,137 @@ class ES(Elasticsearch):
                 log.error(failure)  # TODO: proper failure processing
         else:
             log.info(DENORMALIZE_SUMMARY, result)
+
+    def index_stats(self):
+        '''
+        Get mapping profile, documents count and store size
+        for each concrete index behind the current index
+        '''
+        stats = self.indices.stats(index=self.config.index, metric='docs,store')['indices']
+        mappings = self.indices.get_mapping(index=self.config.index, doc_type=self.doc_class._doc_type.name)
+        return {
+            name: {
+                'mapping': self.mapping_profile(mappings.get(name, {})),
+                'documents': index['primaries']['docs']['count'],
+                'primaries_size': index['primaries']['store']['size_in_bytes'],
+                'total_size': index['total']['store']['size_in_bytes'],
+            }
+            for name, index in stats.items()
+        }
+
+    def mapping_profile(self, mapping):
+        '''Get the mapping profile an index has been created with from its mapping'''
+        doc_type = mapping.get('mappings', {}).get(self.doc_class._doc_type.name, {})
+        # Indices created before profiles were tracked have the default mapping
+        return doc_type.get('_meta', {}).get('profile', 'default')
+
+    def register_repository(self, repository=SNAPSHOT_REPOSITORY, location=SNAPSHOT_LOCATION):
+        '''Register (or update) a filesystem snapshot repository'''
+        log.info('Registering snapshot repository %s into %s', repository, location)
+        self.snapshot.create_repository(repository=repository, body={
+            'type': 'fs',
+            'settings': {
+                'location': location,
+                'compress': True,
+            }
+        })
+
+    def concrete_indices(self, name):
+        '''Get the concrete indices names behind an index or an alias name'''
+        return sorted(self.indices.get_alias(index=name).keys())
+
+    def snapshot_index(self, snapshot=None, repository=SNAPSHOT_REPOSITORY, location=SNAPSHOT_LOCATION):
+        '''
+        Snapshot the current index into a filesystem repository.
+
+        Returns the snapshot name.
+        '''
+        snapshot = snapshot or '{0}-{1:%Y%m%d%H%M%S}'.format(self.config.index, datetime.now())
+        try:
+            self.register_repository(repository, location)
+            indices = self.concrete_indices(self.config.index)
+            log.info('Snapshotting %s into %s/%s', ', '.join(indices), repository, snapshot)
+            result = self.snapshot.create(repository=repository, snapshot=snapshot, body={
+                'indices': ','.join(indices),
+                'include_global_state': False,
+            }, wait_for_completion=True, request_timeout=SNAPSHOT_TIMEOUT)
+        except TransportError as e:
+            raise ValueError('Unable to snapshot {0}: {1}'.format(self.config.index, e))
+        info = result['snapshot']
+        if info['state'] != 'SUCCESS':
+            raise ValueError('Snapshot {0} ended with state {1}: {2}'.format(
+                snapshot, info['state'], info.get('failures')))
+        return snapshot
+
+    def restore_index(self, snapshot, target=None, alias=None, replace=False,
+                      repository=SNAPSHOT_REPOSITORY, location=SNAPSHOT_LOCATION):
+        '''
+        Restore a snapshotted index under a new name.
+
+        If `alias` is given, it is switched to the restored index.
+        If `alias` is the name of an existing index (ie. created before indices were aliased),
+        this index is deleted once restored only if `replace` is `True`.
+        Returns the restored index name.
+        '''
+        target = target or '{0}-{1}'.format(self.config.index, snapshot)
+        try:
+            legacy = alias and self.indices.exists(index=alias) and not self.indices.exists_alias(name=alias)
+            target_exists = self.indices.exists(index=target)
+        except TransportError as e:
+            raise ValueError('Unable to check existing indices: {0}'.format(e))
+        if legacy and not replace:
+            raise ValueError('"{0}" is an index, unable to use it as an alias (see --replace)'.format(alias))
+        if target_exists:
+            raise ValueError('Index "{0}" already exists'.format(target))
+        try:
+            self.register_repository(repository, location)
+            snapshots = self.snapshot.get(repository=repository, snapshot=snapshot)['snapshots']
+        except NotFoundError:
+            raise ValueError('Unknown snapshot {0}/{1}'.format(repository, snapshot))
+        except TransportError as e:
+            raise ValueError('Unable to get snapshot {0}/{1}: {2}'.format(repository, snapshot, e))
+        indices = snapshots[0]['indices']
+        if len(indices) != 1:
+            raise ValueError('Snapshot {0} should contain exactly one index, found: {1}'.format(
+                snapshot, ', '.join(indices)))
+        source = indices[0]
+        log.info('Restoring %s/%s:%s as %s', repository, snapshot, source, target)
+        try:
+            self.snapshot.restore(repository=repository, snapshot=snapshot, body={
+                'indices': source,
+                'include_global_state': False,
+                # Aliases are only handled by `switch_alias`
+                'include_aliases': False,
+                'rename_pattern': '^{0}$'.format(re.escape(source)),
+                'rename_replacement': target,
+            }, wait_for_completion=True, request_timeout=SNAPSHOT_TIMEOUT)
+        except TransportError as e:
+            raise ValueError('Unable to restore {0}/{1}: {2}'.format(repository, snapshot, e))
+        if legacy:
+            log.warning('Deleting index %s to replace it by an alias', alias)
+            try:
+                self.indices.delete(index=alias)
+            except TransportError as e:
+                raise ValueError(
+                    'Snapshot restored as {0} but unable to delete index {1}: {2}. '
+                    'Delete it and point the {1} alias to {0} by hand.'.format(target, alias, e))
+        if alias:
+            try:
+                self.switch_alias(alias, target)
+            except TransportError as e:
+                raise ValueError(
+                    'Snapshot restored as {0} but unable to point the {1} alias to it: {2}. '
+                    'Point the {1} alias to {0} by hand.'.format(target, alias, e))
+        return target
+
+    def switch_alias(self, alias, index):
+        '''Atomically point an alias to a given index only'''
+        actions = []
+        if self.indices.exists_alias(name=alias):
+            actions.extend(
+                {'remove': {'index': name, 'alias': alias}}
+                for name in self.concrete_indices(alias) if name != index
+            )
+        actions.append({'add': {'index': index, 'alias': alias}})
+        log.info('Switching alias %s to %s', alias, index)
+        self.indices.update_aliases(body={'actions': actions})
@@ -1,13 +1,16 @@
 import configparser
 import csv
+import json
 import logging
 import os
 
 from collections import Counter
+from functools import partial
+from itertools import count, groupby
 from pathlib import Path
 
-from .database import ES
-from .utils import ObjectDict
+from .database import ES, BULK_CHUNK_SIZE, FastJSONSerializer, log_error
+from .utils import ObjectDict, format_error
 
 log = logging.getLogger(__name__)
 
@@ -21,52 +24,217 @@ Summary:
 '''.strip()
 
 
+#: Replay selections of dead-letter records
+REPLAY_REJECTED = 'rejected'
+REPLAY_INDEXED = 'indexed'
+REPLAY_ALL = 'all'
+REPLAY_SELECTIONS = (REPLAY_REJECTED, REPLAY_INDEXED, REPLAY_ALL)
+
+#: Key under which extra values of rows having too many columns are stored
+EXTRA_KEY = '_extra'
+
+
+def iter_lines(binary_file, encoding, errors, size=None):
+    '''
+    Decode a binary file line by line, storing decoding errors by line number
+
+    If `size` is given, only lines starting in the next `size` bytes are read.
+    '''
+    position = 0
+    for number, line in enumerate(binary_file, 1):
+        if size is not None and position >= size:
+            return
+        position += len(line)
+        try:
+            yield line.decode(encoding)
+        except UnicodeDecodeError as e:
+            errors[number] = e
+            yield line.decode(encoding, 'replace')
+
+
+def iter_csv(path, lines=None, progress=None, encoding='cp1252', delimiter=';', on_error=None,
+             start=0, end=None):
+    '''
+    Iterate over a CSV file rows as `(line number, data)` pairs
+
+    Unreadable rows (undecodable or malformed) are given to
+    the `on_error(source, line, error, data)` callback and skipped if provided,
+    otherwise the error is raised.
+
+    `start` and `end` restrict the iteration to the rows starting in this bytes range
+    so a file can be processed in parallel by ranges. Line numbers are then relative
+    to the range and rows spanning many lines can't overlap ranges bounds.
+    '''
+    decode_errors = {}
+    with path.open('rb') as csv_file:
+        fieldnames = None
+        position = 0
+        if start:
+            header = csv_file.readline().decode(encoding)
+            fieldnames = next(csv.reader([header], delimiter=delimiter))
+            # Skip the partial line (if any) to start on a line boundary
+            csv_file.seek(start - 1)
+            position = start - 1 + len(csv_file.readline())
+        size = None if end is None else max(end - position, 0)
+        csv_lines = iter_lines(csv_file, encoding, decode_errors, size)
+        reader = csv.DictReader(csv_lines, fieldnames=fieldnames, delimiter=delimiter, restkey=EXTRA_KEY)
+        for i in count():
+            start = reader.line_num
+            try:
+                data = next(reader)
+            except StopIteration:
+                break
+            except csv.Error as e:
+                error = e
+            else:
+                errors = [decode_errors.pop(n) for n in range(start + 1, reader.line_num + 1) if n in decode_errors]
+                error = errors[0] if errors else None
+
+            if i and progress and not i % progress:
+                log.info('%d lines loaded', i)
+
+            if lines and i > lines:
+                break
+
+            if error is None:
+                yield reader.line_num, data
+            elif on_error:
+                on_error(path, reader.line_num, format_error(error), None)
+            else:
+                raise error
+
+
+def iter_insee_csv(path, lines=None, progress=None, on_error=None, start=0, end=None):
+    return iter_csv(path, lines, progress, on_error=on_error, start=start, end=end)
+
+
+def iter_geo_csv(path, lines=None, progress=None, on_error=None, start=0, end=None):
+    return iter_csv(path, lines, progress, encoding='utf-8', delimiter=',', on_error=on_error,
+                    start=start, end=end)
+
+
+def iter_files(path):
+    '''Iterate over the CSV files of a path, being a single file or a directory'''
+    path = Path(path)
+    if path.is_dir():
+        yield from sorted(path.glob('*.csv'))
+    else:
+        yield path
+
+
+class DeadLetter(object):
+    '''
+    Keep track of rejected rows into a JSON lines file.
+
+    Each line stores the source file, the line number, the command which rejected it,
+    the error, the raw row and whether the row has been indexed anyway (without its invalid values)
+    so they can be replayed later without reloading the full source file.
+    Unreadable rows are stored without raw row.
+    Without filename, rejected rows are only logged.
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.file = None
+        self.count = 0
+        self.indexed = 0
+        self.serializer = FastJSONSerializer()
+
+    def __enter__(self):
+        if self.filename:
+            self.file = open(self.filename, 'wb')
+        return self
+
+    def __exit__(self, *args):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.count:
+            log.warning('%d rows rejected', self.count)
+        if self.indexed:
+            log.warning('%d rows indexed without invalid values', self.indexed)
+
+    def reject(self, source, line, error, data, command=None, indexed=False):
+        '''Record a rejected row (never raises)'''
+        if indexed:
+            self.indexed += 1
+        else:
+            self.count += 1
+        log_error(source, line, error, data, indexed)
+        self.write({
+            'source': str(source),
+            'line': line,
+            'command': command,
+            'indexed': indexed,
+            'error': error,
+            'row': data,
+        })
+
+    def write(self, record):
+        '''Write a record as is into the dead-letter file (never raises)'''
+        if not self.file:
+            return
+        try:
+            content = self.serializer.dumps_bytes(record)
+        except Exception:
+            # Rows which can't be serialized as is (ie. non string keys) are stringified
+            try:
+                content = json.dumps(record, default=str, ensure_ascii=False, skipkeys=True).encode('utf-8')
+            except Exception:
+                log.exception('Unable to write rejected row %s:%s', record['source'], record['line'])
+                return
+        self.file.write(content)
+        self.file.write(b'\n')
+
+    def rejecter(self, command):
+        '''Get a rejected rows callback for a given command'''
+        return partial(self.reject, command=command)
+
+    def read(self, filename):
+        '''Iterate over the records of a dead-letter file'''
+        with open(filename, 'rb') as dead_letter_file:
+            for line in dead_letter_file:
+                if line.strip():
+                    yield self.serializer.loads(line)
+
+
 class Loader(object):
-    def __init__(self, config):
+    def __init__(self, config, deadletter=None):
         self.config = config
         self.es = ES(config)
+        self.deadletter = deadletter or DeadLetter()
 
     def iter_csv(self, path, lines=None, progress=None, encoding='cp1252', delimiter=';'):
-        with path.open(encoding=encoding) as csv_file:
-            for i, data in enumerate(csv.DictReader(csv_file, delimiter=delimiter)):
-                if i and progress and not i % progress:
-                    log.info('%d lines loaded', i)
-
-                if lines and i > lines:
-                    break
+        return iter_csv(path, lines, progress, encoding, delimiter)
 
-                yield i, data
+    def iter_insee_csv(self, path, lines=None, progress=None, on_error=None):
+        return iter_insee_csv(path, lines, progress, on_error)
 
-    def iter_insee_csv(self, path, lines=None, progress=None):
-        return self.iter_csv(path, lines, progress)
+    def iter_geo_csv(self, path, lines=None, progress=None, on_error=None):
+        return iter_geo_csv(path, lines, progress, on_error)
 
-    def iter_geo_csv(self, path, lines=None, progress=None):
-        return self.iter_csv(path, lines, progress, encoding='utf-8', delimiter=',')
-
-    def load(self, filename, lines=None, progress=None, geo=False):
+    def load(self, filename, lines=None, progress=None, geo=False, chunk_size=BULK_CHUNK_SIZE):
         log.info('Loading stock data from  %s', filename)
         path = Path(filename)
         total = 0
         if path.is_dir():
             log.info('Loading data from %s directory', path)
             for i, file in enumerate(path.glob('*.csv')):
-                total += self.process_stock_file(file, total, lines, progress, geo)
+                total += self.process_stock_file(file, lines, progress, geo, chunk_size)
                 log.debug('%d file processed', i)
         else:
-            total += self.process_stock_file(path, total, lines, progress)
+            total += self.process_stock_file(path, lines, progress, geo, chunk_size)
         log.info('%d items loaded with success', total)
 
-    def process_stock_file(self, file, total, lines=None, progress=None, geo=False):
+    def process_stock_file(self, file, lines=None, progress=None, geo=False, chunk_size=BULK_CHUNK_SIZE):
         log.info('Processing %s', file)
         processor = self.iter_geo_csv if geo else self.iter_insee_csv
-        i = 0
-        for i, data in processor(file, lines, progress):
-            self.es.save_company(data)
-        total += i
-        log.info('%d items loaded with from file', i)
-        return i
-
-    def update(self, filename, lines=None, progress=None):
+        reject = self.deadletter.rejecter('load')
+        rows = processor(file, lines, progress, reject)
+        total = self.es.save_companies(rows, chunk_size, file, reject)
+        log.info('%d items loaded with from file', total)
+        return total
+
+    def update(self, filename, lines=None, progress=None, chunk_size=BULK_CHUNK_SIZE):
         path = Path(filename)
         counter = Counter({
             'creations': 0,
@@ -79,16 +247,23 @@ class Loader(object):
         if path.is_dir():
             log.info('Loading updates from %s directory', path)
             for file in path.glob('*.csv'):
-                self.process_update_file(file, counter, lines, progress)
+                self.process_update_file(file, counter, lines, progress, chunk_size)
         else:
             log.info('Loading updates from %s', path)
-            self.process_update_file(path, counter, lines, progress)
+            self.process_update_file(path, counter, lines, progress, chunk_size)
         log.info('%(total)d items loaded with success', counter)
 
-    def process_update_file(self, file, counter, lines=None, progress=None):
+    def process_update_file(self, file, counter, lines=None, progress=None, chunk_size=BULK_CHUNK_SIZE):
         log.info('Processing %s', file)
-        for i, data in self.iter_insee_csv(file, lines, progress):
-            vmaj = data['VMAJ']
+        reject = self.deadletter.rejecter('update')
+        rows = self.iter_update_rows(self.iter_insee_csv(file, lines, progress, reject), file, counter)
+        counter['total'] += self.es.save_companies(rows, chunk_size, file, reject, self.prepare_update)
+        log.info(FILE_SUMMARY, counter)
+
+    def iter_update_rows(self, rows, file, counter):
+        '''Filter the `(line, data)` rows of an update file to save, keeping track of their types'''
+        for line, data in rows:
+            vmaj = data.get('VMAJ')
             is_creation = vmaj == 'C'
             is_update_old = vmaj == 'I'
             is_update_new = vmaj == 'F'
@@ -99,10 +274,8 @@ class Loader(object):
             if is_creation:
                 counter['creations'] += 1
             elif is_update_old:
-                # We remove one day from DATEMAJ to keep track of that state,
-                # might be useful if company hasn't been loaded from stock.
-                # TODO: really convert to a date! (or do not keep line?)
-                data['DATEMAJ'] = str(int(data['DATEMAJ']) - 1)
+                # DATEMAJ is adjusted by `prepare_update`
+                pass
             elif is_update_new:
                 counter['modifications'] += 1
                 # TODO: make sure that infos about the modif are propagated.
@@ -114,12 +287,61 @@ class Loader(object):
             elif is_not_commercial:
                 counter['not_commercial'] += 1
             else:
-                log.error('Update type not supported: "%s"', vmaj)
+                self.deadletter.reject(file, line, 'Update type not supported: "{0}"'.format(vmaj), data, 'update')
                 continue
 
-            self.es.save_company(data)
-        counter['total'] += i
-        log.info(FILE_SUMMARY, counter)
+            yield line, data
+
+    def prepare_update(self, data):
+        '''Get the data to save from an update file row (given row is left untouched)'''
+        if data.get('VMAJ') == 'I':
+            # We remove one day from DATEMAJ to keep track of that state,
+            # might be useful if company hasn't been loaded from stock.
+            # TODO: really convert to a date! (or do not keep line?)
+            data = dict(data, DATEMAJ=str(int(data['DATEMAJ']) - 1))
+        return data
+
+    def replay(self, filename, chunk_size=BULK_CHUNK_SIZE, select=REPLAY_REJECTED):
+        '''
+        Save again the rows rejected into a dead-letter file
+
+        `select` is either `rejected` (rows which haven't been indexed),
+        `indexed` (rows indexed without their invalid values) or `all`.
+        Records not selected are kept as is into the new dead-letter file.
+        Rows rejected by an update are processed again as update rows.
+        Unreadable rows can't be replayed and are rejected again.
+        '''
+        log.info('Replaying %s rows from %s', select, filename)
+        total = 0
+        counter = Counter()
+        records = self.iter_selected_records(self.deadletter.read(filename), select)
+        for (source, command), group in groupby(records, key=lambda r: (r['source'], r.get('command'))):
+            reject = self.deadletter.rejecter(command)
+            rows = self.iter_replayable_rows(group, reject)
+            if command == 'update':
+                rows = self.iter_update_rows(rows, source, counter)
+                total += self.es.save_companies(rows, chunk_size, source, reject, self.prepare_update)
+            else:
+                total += self.es.save_companies(rows, chunk_size, source, reject)
+        log.info('%d items replayed with success', total)
+        return total
+
+    def iter_selected_records(self, records, select):
+        '''Filter dead-letter records to replay, keeping the others into the new dead-letter file'''
+        for record in records:
+            indexed = record.get('indexed', False)
+            if select == REPLAY_ALL or indexed == (select == REPLAY_INDEXED):
+                yield record
+            else:
+                self.deadletter.write(record)
+
+    def iter_replayable_rows(self, records, on_error):
+        '''Iterate over dead-letter records as `(line, data)` rows, rejecting those without data'''
+        for record in records:
+            if record['row'] is None:
+                on_error(record['source'], record['line'], record['error'], None)
+            else:
+                yield record['line'], record['row']
 
     def denormalize(self, filename, force=False):
         specs = configparser.ConfigParser()
@@ -0,0 +1,254 @@
+import hashlib
+import logging
+import math
+import os
+
+from collections import Counter
+from datetime import datetime
+from multiprocessing import Pool
+
+from .database import MAPPING, DATE_MAPPING, INTEGER_MAPPING, BOOLEAN_MAPPING
+from .loader import iter_insee_csv, iter_geo_csv, iter_files
+
+log = logging.getLogger(__name__)
+
+#: HyperLogLog registers index bits (2^14 registers, ~0.8% standard error)
+HLL_PRECISION = 14
+
+#: Default amount of most frequent values reported by field
+TOP_K = 10
+
+#: Amount of tracked values by top-k item before pruning
+TOP_K_FACTOR = 100
+
+#: Minimum size (in bytes) of a file range processed by a worker
+MIN_RANGE_SIZE = 16 * 1024 * 1024
+
+
+class HyperLogLog(object):
+    '''
+    An approximate distinct values counter using a constant memory.
+
+    Hashes are stable across processes so counters computed
+    in different workers can be merged.
+    '''
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        digest = hashlib.md5(value.encode('utf-8')).digest()
+        x = int.from_bytes(digest[:8], 'big')
+        bits = 64 - self.precision
+        index = x >> bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if zeros and estimate <= 2.5 * m:
+            # Small range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class TopK(object):
+    '''
+    An approximate most frequent values counter using a bounded memory.
+
+    This is a Misra-Gries summary: when too many values are tracked,
+    the lowest half is dropped and its count is substracted from the others.
+    Reported counts are then underestimated by at most `error`.
+    '''
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self.capacity = k * TOP_K_FACTOR
+        self.counts = Counter()
+        self.error = 0
+
+    def add(self, value):
+        self.counts[value] += 1
+        if len(self.counts) > self.capacity:
+            self.prune()
+
+    def prune(self):
+        threshold = sorted(self.counts.values())[len(self.counts) // 2]
+        self.error += threshold
+        self.counts = Counter({
+            value: count - threshold for value, count in self.counts.items() if count > threshold
+        })
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.error += other.error
+        while len(self.counts) > self.capacity:
+            self.prune()
+
+    def most_common(self):
+        return self.counts.most_common(self.k)
+
+
+class FieldProfile(object):
+    '''Statistics on a single mapped field values'''
+    def __init__(self, field, column, top=TOP_K):
+        self.field = field
+        self.column = column
+        self.count = 0
+        self.nulls = 0
+        self.errors = Counter()
+        self.distinct = HyperLogLog()
+        self.top = TopK(top)
+
+    def add(self, value):
+        self.count += 1
+        if not value:
+            self.nulls += 1
+            return
+        self.distinct.add(value)
+        self.top.add(value)
+        error = self.check(value)
+        if error:
+            self.errors[error] += 1
+
+    def check(self, value):
+        '''Get the error kind for a given value if any'''
+        return None
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        self.errors.update(other.errors)
+        self.distinct.merge(other.distinct)
+        self.top.merge(other.top)
+
+    def to_dict(self):
+        return {
+            'column': self.column,
+            'count': self.count,
+            'nulls': self.nulls,
+            'null_rate': self.nulls / self.count if self.count else 0,
+            'distinct': self.distinct.count(),
+            'top': self.top.most_common(),
+            'top_error': self.top.error,
+            'errors': dict(self.errors),
+        }
+
+
+class DateFieldProfile(FieldProfile):
+    def __init__(self, field, column, fmt, top=TOP_K):
+        super().__init__(field, column, top)
+        self.fmt = fmt
+
+    def check(self, value):
+        try:
+            datetime.strptime(value, self.fmt)
+        except ValueError:
+            return 'invalid_date'
+
+
+class IntegerFieldProfile(FieldProfile):
+    def check(self, value):
+        if value == 'NN':
+            return 'nn'
+        try:
+            int(value)
+        except ValueError:
+            return 'invalid_integer'
+
+
+class Profile(object):
+    '''Statistics on all mapped fields of one or many CSV files'''
+    def __init__(self, top=TOP_K):
+        self.files = []
+        self.rows = 0
+        self.unreadable_rows = 0
+        self.fields = [FieldProfile(field, column, top) for field, column in MAPPING.items()]
+        self.fields.extend(
+            DateFieldProfile(field, column, fmt, top) for field, (column, fmt) in DATE_MAPPING.items()
+        )
+        self.fields.extend(IntegerFieldProfile(field, column, top) for field, column in INTEGER_MAPPING.items())
+        self.fields.extend(FieldProfile(field, column, top) for field, column in BOOLEAN_MAPPING.items())
+
+    def add(self, data):
+        self.rows += 1
+        for field in self.fields:
+            field.add(data.get(field.column))
+
+    def unreadable(self, source, line, error, data):
+        '''Count an unreadable row (used as `on_error` callback)'''
+        log.debug('Unreadable row %s:%s: %s', source, line, error)
+        self.unreadable_rows += 1
+
+    def merge(self, other):
+        self.files.extend(other.files)
+        self.rows += other.rows
+        self.unreadable_rows += other.unreadable_rows
+        for field, other_field in zip(self.fields, other.fields):
+            field.merge(other_field)
+
+    def to_dict(self):
+        return {
+            'files': sorted(str(f) for f in self.files),
+            'rows': self.rows,
+            'unreadable_rows': self.unreadable_rows,
+            'fields': {field.field: field.to_dict() for field in self.fields},
+        }
+
+
+def profile_range(args):
+    '''Profile a bytes range of a CSV file (executed into a worker process)'''
+    path, start, end, lines, progress, geo, top = args
+    log.info('Profiling %s (bytes %d to %s)', path, start, end if end is not None else 'end')
+    processor = iter_geo_csv if geo else iter_insee_csv
+    profile = Profile(top)
+    if not start:
+        profile.files.append(path)
+    for _, data in processor(path, lines, progress, on_error=profile.unreadable, start=start, end=end):
+        profile.add(data)
+    log.info('%d rows profiled from %s (%d unreadable)', profile.rows, path, profile.unreadable_rows)
+    return profile
+
+
+def split(files, workers):
+    '''
+    Split files into `(path, start, end)` bytes ranges
+    so the work is balanced between workers.
+    '''
+    sizes = [f.stat().st_size for f in files]
+    range_size = max(MIN_RANGE_SIZE, math.ceil(sum(sizes) / workers))
+    for path, size in zip(files, sizes):
+        starts = list(range(0, size, range_size)) or [0]
+        ends = starts[1:] + [None]
+        for start, end in zip(starts, ends):
+            yield path, start, end
+
+
+def profile(paths, lines=None, progress=None, geo=False, top=TOP_K, workers=None):
+    '''
+    Profile the mapped fields of some CSV files in a single pass.
+
+    Files are split into bytes ranges (unless `lines` is given),
+    each range is processed by a worker process and results are merged.
+    '''
+    files = [f for path in paths for f in iter_files(path)]
+    workers = workers or os.cpu_count() or 1
+    ranges = [(f, 0, None) for f in files] if lines else list(split(files, workers))
+    workers = min(workers, len(ranges)) or 1
+    tasks = [(path, start, end, lines, progress, geo, top) for path, start, end in ranges]
+    result = Profile(top)
+    if workers > 1:
+        with Pool(workers) as pool:
+            for range_profile in pool.imap_unordered(profile_range, tasks):
+                result.merge(range_profile)
+    else:
+        for task in tasks:
+            result.merge(profile_range(task))
+    return result
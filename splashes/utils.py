@@ -1,6 +1,8 @@
 import os
 import sys
 
+from itertools import islice
+
 
 class ObjectDict(dict):
     '''A dictionnary with object-like value access'''
@@ -17,3 +19,27 @@ class ObjectDict(dict):
 def is_tty():
     '''Check wether the current process output to a tty or not'''
     return os.isatty(sys.stdout.fileno()) and not sys.platform.startswith('win')
+
+
+def format_error(error):
+    '''Format an exception as a short one-line message'''
+    return '{0}: {1}'.format(error.__class__.__name__, error)
+
+
+def human_size(size):
+    '''Format a size in bytes into a human readable string'''
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '{0:.1f}{1}'.format(size, unit)
+        size /= 1024
+    return '{0:.1f}TB'.format(size)
+
+
+def chunked(iterable, size):
+    '''Iterate over an iterable by lists of at most `size` items'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk